@@ -1,11 +1,51 @@
+import argparse
 import webbrowser
 import threading
-from src.app import run_app
+from urllib.parse import urlsplit
+from src.app import run_app, default_redirect_uri
 
 if __name__ == "__main__":
-    # Start the FastHTML app in a separate thread
-    server_thread = threading.Thread(target=run_app)
-    server_thread.start()
+    parser = argparse.ArgumentParser(description="Launch the dashboard.")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=5001)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of Uvicorn worker processes"
+    )
+    parser.add_argument(
+        "--redirect-uri",
+        help=(
+            "OAuth redirect URI registered with Monzo (default: "
+            "http://<host>:<port>/auth/callback)"
+        )
+    )
+    args = parser.parse_args()
+    redirect_uri = args.redirect_uri or default_redirect_uri(args.host, args.port)
 
-    # Open app in default browser
-    webbrowser.open("http://localhost:5001/")
+    # Open app in default browser once the server has had a moment to start.
+    # Use the same address as the redirect URI so that the session cookie is
+    # sent back with the callback. The server itself must run in the main
+    # thread as Uvicorn installs signal handlers when running multiple
+    # workers.
+    url = urlsplit(redirect_uri)
+    browser_timer = threading.Timer(
+        1.0,
+        webbrowser.open,
+        args=(f"{url.scheme}://{url.netloc}/",)
+    )
+    browser_timer.start()
+
+    # Start the FastHTML app. Don't open the browser if it fails to start
+    # (e.g. because of an invalid redirect URI).
+    try:
+        run_app(
+            host=args.host,
+            port=args.port,
+            workers=args.workers,
+            redirect_uri=redirect_uri
+        )
+    except Exception:
+        browser_timer.cancel()
+        raise
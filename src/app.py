@@ -1,10 +1,12 @@
 # type: ignore # ignore Pylance warnings in this file as FastHTML is not
 # compatible with Pylance.
 # See: https://github.com/AnswerDotAI/fasthtml/issues/329#issue-2471897892
+import os
 import requests
 import uvicorn
 from fasthtml.common import *
 from datetime import datetime
+from urllib.parse import urlsplit
 from src.utils import (
     gen_rand_str,
     get_update_date,
@@ -12,28 +14,65 @@ from src.utils import (
     access_token_refresh_needed
 )
 from src.monzo_api import fetch_transactions
-from src.dashboard_components import plot_spending_by_category
+from src.recurring_payments import update_recurring_payments
+from src.dashboard_components import (
+    plot_spending_by_category,
+    recurring_payments_table
+)
 
-# URLs used in OAuth2 flow. See `/auth` and `/auth/callback` routes
+# URLs used in OAuth2 flow. See `/auth` and `/auth/callback` routes.
 BASE_AUTH_URL = "https://auth.monzo.com/"
 TOKEN_URL = "https://api.monzo.com/oauth2/token"
-REDIRECT_URI = "http://localhost:5001/auth/callback"
-
-# `oauth_state` is set in the `/auth` POST route to a 16-character random
-# string to prevent against CSRF attacks. This is required by Monzo.
-# See: https://docs.monzo.com/#acquire-an-access-token
-#
-# `auth_code` is extracted from the callback URL after two-factor
-# authentication with Monzo via email.
-oauth_state = None
-auth_code = None
-
-def run_app() -> None:
+REDIRECT_PATH = "/auth/callback"
+
+# The redirect URI must exactly match the redirect URL of the OAuth client
+# set up on https://developers.monzo.com/ and must end in `REDIRECT_PATH`.
+# It is set by `run_app` (e.g. to the public HTTPS URL when running behind a
+# load balancer) and passed to each worker process via this environment
+# variable, as worker processes do not share module globals.
+REDIRECT_URI_ENV = "MONZO_REDIRECT_URI"
+
+# FastHTML signs session cookies with the secret key stored in this file.
+# Every worker must use the same key, otherwise a worker cannot read a
+# session cookie set by another worker.
+SESSION_KEY_FILE = ".sesskey"
+
+def default_redirect_uri(host: str = "localhost", port: int = 5001) -> str:
+    """Returns the redirect URI used when the app is accessed directly at
+    `host` and `port`, e.g. "http://localhost:5001/auth/callback". If the
+    app listens on all interfaces (e.g. `0.0.0.0`), `localhost` is used.
+    Other IPv6 addresses are wrapped in brackets, e.g. `[::1]`.
+    """
+    if host in ("0.0.0.0", "::"):
+        host = "localhost"
+    elif ":" in host and not host.startswith("["):
+        host = f"[{host}]"
+    return f"http://{host}:{port}{REDIRECT_PATH}"
+
+
+def run_app(
+    host: str = "localhost",
+    port: int = 5001,
+    workers: int = 1,
+    redirect_uri: str | None = None
+) -> None:
     """Starts the FastHTML application server.
 
     This function launches the FastHTML app by invoking Uvicorn, a
-    lightweight ASGI server for Python. The app listens on localhost at
-    port 5001.
+    lightweight ASGI server for Python. By default, the app listens on
+    localhost at port 5001 using a single worker process.
+
+    `redirect_uri` is the OAuth redirect URI registered with Monzo. It
+    defaults to `default_redirect_uri(host, port)`, but must be set to
+    the public URL (e.g. "https://example.com/auth/callback") when the
+    app is served behind a load balancer or reverse proxy. Its path must
+    be `REDIRECT_PATH`, otherwise a `ValueError` is raised.
+
+    All per-user state (including the OAuth `state` token) is stored in
+    the signed session cookie, so the app can be served by several
+    `workers` (or behind a load balancer): a request can be handled by
+    any worker that shares the session key in `.sesskey`. With more than
+    one worker, Uvicorn must be started from the main thread.
 
     The FastHTML app includes routes for:
       - `/auth`: Handles OAuth2 authentication with Monzo.
@@ -41,15 +80,71 @@ def run_app() -> None:
         authentication.
       - `/dashboard`: Displays a dashboard for authenticated users.
     """
+    # Monzo redirects the user to this URI after authenticating, so it must
+    # point at the `/auth/callback` route
+    if redirect_uri is None:
+        redirect_uri = default_redirect_uri(host, port)
+    if urlsplit(redirect_uri).path != REDIRECT_PATH:
+        raise ValueError(
+            f"Redirect URI {redirect_uri!r} must have the path {REDIRECT_PATH!r}, "
+            f"e.g. 'https://example.com{REDIRECT_PATH}'."
+        )
+
+    # Create the session key and database before the workers start so that
+    # they all use the same key rather than racing to create their own
+    get_key(fname=SESSION_KEY_FILE)
+    setup_database()
+
+    # Worker processes inherit the environment, so `create_app` can read the
+    # redirect URI from there
+    os.environ[REDIRECT_URI_ENV] = redirect_uri
+
+    # Uvicorn needs an import string (rather than the `create_app` function
+    # itself) to start the app in each worker process
     uvicorn.run(
-        create_app,
-        host="localhost",
-        port=5001,
+        "src.app:create_app",
+        host=host,
+        port=port,
+        workers=workers,
         reload=False,
         factory=True
     )
 
 
+def setup_database() -> Database:
+    """Creates `data/transactions.db` and its tables if they do not
+    already exist and returns the database connection. This is called by
+    `run_app` before any workers start (so that they do not race to create
+    the same tables) and again by `create_app` in each worker.
+    """
+    db = database("data/transactions.db")
+    transactions = db.t.transactions
+
+    if transactions not in db.t:
+        transactions.create(
+            dict(
+                created=str,
+                amount=int,
+                description=str,
+                merchant_name=str,
+                category=str,
+                tags=str,
+                address=str,
+                website=str
+            ),
+            pk="id"
+        )
+
+    # Recurring payments are cached in `data/transactions.db` and updated
+    # after each call to `fetch_transactions`. If the cache does not exist
+    # yet (e.g. transactions were fetched by an older version of the app),
+    # build it from the full transaction history.
+    if db.t.recurring_payments not in db.t:
+        update_recurring_payments()
+
+    return db
+
+
 def create_app() -> FastHTML:
     """Creates and configures a FastHTML application that authenticates
     with Monzo's API and provides a simple dashboard interface. This
@@ -72,23 +167,11 @@ def create_app() -> FastHTML:
     """
 
     # If `data/transactions.db` does not already exist, create it
-    db = database("data/transactions.db")
-    transactions = db.t.transactions
+    db = setup_database()
 
-    if transactions not in db.t:
-        transactions.create(
-            dict(
-                created=str,
-                amount=int,
-                description=str,
-                merchant_name=str,
-                category=str,
-                tags=str,
-                address=str,
-                website=str
-            ),
-            pk="id"
-        )
+    # Set by `run_app`. Falls back to the default for the default host/port.
+    redirect_uri = os.environ.get(REDIRECT_URI_ENV, default_redirect_uri())
+    transactions = db.t.transactions
 
     # The `.dataclass()` method creates a dataclass that defines the type
     # of database entries
@@ -143,6 +226,7 @@ def create_app() -> FastHTML:
     # Create FastHTML app
     app, rt = fast_app(
         before=bware,
+        key_fname=SESSION_KEY_FILE,
         exception_handlers={404: _not_found},
         hdrs=(
             picolink,
@@ -199,6 +283,7 @@ def create_app() -> FastHTML:
                     hx_target="#dashboard-components",
                     hx_swap="innerHTML"
                 ),
+                Div(recurring_payments_table(), id="recurring-payments"),
                 Div(id="dashboard-components") # initially empty
             )
         )
@@ -207,7 +292,8 @@ def create_app() -> FastHTML:
     def post(sess):
         """Fetches transactions via Monzo's API and updates
         `data/transactions.db`. Returns the date and time of the update
-        so that it can be displayed on the page.
+        so that it can be displayed on the page, along with the refreshed
+        recurring payments table (swapped in out-of-band).
         """
         access_token = sess["access_token"]
         timestamp = sess["auth_timestamp"]
@@ -219,7 +305,14 @@ def create_app() -> FastHTML:
         fetch_transactions(access_token, verbose=True)
         last_updated = get_update_date()
         update_message = f"Transactions last updated at {last_updated}."
-        return update_message
+        return (
+            update_message,
+            Div(
+                recurring_payments_table(),
+                id="recurring-payments",
+                hx_swap_oob="true"
+            )
+        )
 
     @rt("/update-plots")
     def post(dates: Dates, sess):
@@ -260,7 +353,6 @@ def create_app() -> FastHTML:
     # TODO is it possible to display `auth_url` in a 'mini-browser'?
     @rt("/auth")
     def post(creds: Credentials, sess):
-        global oauth_state
         if not creds.client_id or not creds.client_secret:
             return RedirectResponse("/auth", status_code=303)
 
@@ -268,15 +360,18 @@ def create_app() -> FastHTML:
         sess["client_id"] = creds.client_id
         sess["client_secret"] = creds.client_secret
 
-        # Generate a unique state token to protect against CSRF
-        oauth_state = gen_rand_str()
+        # Generate a unique state token to protect against CSRF. This is
+        # required by Monzo. See: https://docs.monzo.com/#acquire-an-access-token
+        # The token is kept in the session so that it is checked against
+        # the same user's login, whichever worker handles the callback.
+        sess["oauth_state"] = gen_rand_str()
 
         # Create the Monzo authorisation URL
         auth_url = (
             f"{BASE_AUTH_URL}?client_id={creds.client_id}"
-            f"&redirect_uri={REDIRECT_URI}"
+            f"&redirect_uri={redirect_uri}"
             f"&response_type=code"
-            f"&state={oauth_state}"
+            f"&state={sess['oauth_state']}"
         )
 
         return RedirectResponse(auth_url, status_code=303)
@@ -296,16 +391,18 @@ def create_app() -> FastHTML:
     # TODO before proceeding to the dashboard, include a check for whether
     # the user has authenticated via their mobile device as well (check for
     # an error code, then redirect back here)
-    @rt("/auth/callback")
+    @rt(REDIRECT_PATH)
     def get(req, sess):
-        global auth_code
+        # `auth_code` is extracted from the callback URL after two-factor
+        # authentication with Monzo via email
         auth_code = req.query_params.get("code")
         state = req.query_params.get("state")
-        client_id = sess["client_id"]
-        client_secret = sess["client_secret"]
+        client_id = sess.get("client_id")
+        client_secret = sess.get("client_secret")
 
-        # Verify the state token
-        if state != oauth_state:
+        # Verify the state token. Each token can only be used once.
+        oauth_state = sess.pop("oauth_state", None)
+        if oauth_state is None or state != oauth_state:
             return Titled(
                 "Error",
                 Div("Invalid state token. Authentication failed.")
@@ -318,7 +415,7 @@ def create_app() -> FastHTML:
                 "grant_type": "authorization_code",
                 "client_id": client_id,
                 "client_secret": client_secret,
-                "redirect_uri": REDIRECT_URI,
+                "redirect_uri": redirect_uri,
                 "code": auth_code,
             }
         )
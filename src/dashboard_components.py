@@ -1,7 +1,9 @@
 import sqlite3
 import matplotlib.pyplot as plt
 from datetime import datetime
+from fasthtml.common import Table, Thead, Tbody, Tr, Th, Td, Div, H3, P
 from src.utils import matplotlib2fasthtml
+from src.recurring_payments import get_recurring_payments
 
 @matplotlib2fasthtml
 def plot_spending_by_category(start_date: datetime, end_date: datetime):
@@ -43,3 +45,41 @@ def plot_spending_by_category(start_date: datetime, end_date: datetime):
     plt.ylabel("Amount (£)")
     plt.xticks(rotation=45, ha="right")
     plt.tight_layout()
+
+
+def recurring_payments_table():
+    """Lists recurring payments (subscriptions, direct debits, rent, etc.)
+    detected in the transaction history. These are read from the
+    `recurring_payments` cache, which is updated whenever transactions
+    are fetched, so this is quick to render.
+    """
+    results = get_recurring_payments()
+    if not results:
+        return Div(
+            H3("Recurring payments"),
+            P("No recurring payments found.")
+        )
+
+    rows = [
+        Tr(
+            Td(merchant),
+            Td(cadence),
+            Td(f"£{-amount / 100:.2f}"),  # convert pence to pounds
+            Td(datetime.strptime(last, "%Y-%m-%d").strftime("%d %b %Y")),
+            Td(datetime.strptime(nxt, "%Y-%m-%d").strftime("%d %b %Y"))
+        )
+        for merchant, cadence, amount, last, nxt in results
+    ]
+    return Div(
+        H3("Recurring payments"),
+        Table(
+            Thead(Tr(
+                Th("Merchant"),
+                Th("Frequency"),
+                Th("Amount"),
+                Th("Last charged"),
+                Th("Next expected")
+            )),
+            Tbody(*rows)
+        )
+    )
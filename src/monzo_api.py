@@ -1,6 +1,7 @@
 import requests
 import sqlite3
 from datetime import datetime, timedelta
+from src.recurring_payments import update_recurring_payments
 
 def get_account_details(access_token: str) -> tuple[str, str]:
     """Get account ID and account creation date. The latter is used to
@@ -22,7 +23,8 @@ def fetch_transactions(access_token: str, verbose: bool = False) -> None:
     Updates `data/transactions.db`. If the database already exists, it
     retrieves all transactions since the last transaction on file. If
     it doesn't exist, it retrieves all transactions since the account
-    creation date.
+    creation date. Once all transactions have been fetched, the cached
+    recurring payments are updated (see `src/recurring_payments.py`).
 
     Multiple API calls are made to comply with Monzo's API limitations
     on time intervals and the maximum number of transactions per call.
@@ -140,6 +142,10 @@ def fetch_transactions(access_token: str, verbose: bool = False) -> None:
         # Update `block_size` to determine whether we need to keep going
         block_size = len(transactions)
 
+    # Update the cached recurring payments. Only merchants with transactions
+    # that have not yet been analysed are re-analysed.
+    update_recurring_payments()
+
 
 def insert_transactions_to_db(transactions: list) -> None:
     """Inserts a list of cleaned transactions into the transactions
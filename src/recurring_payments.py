@@ -0,0 +1,304 @@
+import sqlite3
+import numpy as np
+
+# Cadences we try to match against, as (label, period in days). A merchant
+# is only labelled as recurring if the median gap between its charges is
+# within `TOLERANCE` of one of these periods.
+CADENCES = (
+    ("weekly", 7.0),
+    ("fortnightly", 14.0),
+    ("monthly", 365.25 / 12),
+    ("quarterly", 365.25 / 4),
+    ("yearly", 365.25),
+)
+
+# Relative tolerance on the gap between charges, e.g. 0.15 allows a
+# "monthly" payment to land anywhere between ~26 and ~35 days apart.
+TOLERANCE = 0.15
+
+# Minimum number of charges (and the fraction of gaps that must fall within
+# tolerance) before a merchant is treated as a recurring payment
+MIN_OCCURRENCES = 3
+MIN_REGULAR_FRACTION = 0.75
+
+# Relative tolerance on the amount of each charge, and the fraction of
+# charges that must be within it of the merchant's median amount. This
+# stops regular but variable spending (e.g. a weekly food shop) from being
+# listed as a subscription, while allowing for the occasional price rise.
+AMOUNT_TOLERANCE = 0.2
+MIN_CONSISTENT_FRACTION = 0.75
+
+# Transactions are grouped by merchant name, falling back to the
+# description for payments without a merchant (e.g. direct debits,
+# standing orders and bank transfers)
+MERCHANT_KEY = "COALESCE(merchant_name, description)"
+
+
+def create_recurring_payments_table(conn: sqlite3.Connection) -> None:
+    """Creates the `recurring_payments` table in `data/transactions.db`
+    if it does not already exist. This table caches the output of
+    `detect_recurring_payments` so that the dashboard does not need to
+    scan the whole transaction history on every page load.
+
+    Also creates the single-row `recurring_payments_meta` table, which
+    records the `created` timestamp of the newest transaction that has
+    been analysed.
+    """
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS recurring_payments_meta (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            last_analysed TEXT
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS recurring_payments (
+            merchant TEXT PRIMARY KEY,
+            cadence TEXT,
+            interval_days REAL,
+            amount INTEGER,
+            occurrences INTEGER,
+            last_charged TEXT,
+            next_expected TEXT
+        )
+        """
+    )
+
+
+def group_median(
+    values: np.ndarray,
+    group: np.ndarray,
+    n_groups: int
+) -> np.ndarray:
+    """Returns the median of `values` within each of `n_groups` groups,
+    where `group` holds the group ID of each value. Groups with no
+    values get a median of 0.
+    """
+    counts = np.bincount(group, minlength=n_groups)
+    sorted_values = values[np.lexsort((values, group))]
+    starts = np.cumsum(counts) - counts
+    nonempty = counts > 0
+    lo = starts + np.maximum(counts - 1, 0) // 2
+    hi = starts + counts // 2
+    median = np.zeros(n_groups)
+    median[nonempty] = (
+        sorted_values[lo[nonempty]] + sorted_values[hi[nonempty]]
+    ) / 2
+    return median
+
+
+def detect_recurring_payments(
+    merchants: np.ndarray,
+    amounts: np.ndarray,
+    created: np.ndarray
+) -> list[dict]:
+    """Detects recurring payments (subscriptions, direct debits, rent,
+    etc.) in a set of outgoing transactions. `merchants`, `amounts` and
+    `created` are equal-length arrays holding the merchant key, amount
+    (in pence) and creation timestamp (`datetime64`) of each
+    transaction.
+
+    Returns a list of dicts, one per recurring merchant, with the keys
+    used by the `recurring_payments` table.
+
+    Notes
+    -----
+    Everything is done in a single vectorised pass over the history:
+      1. Merchants are mapped to integer group IDs with `np.unique`, and
+         transactions are sorted by (group, time) with `np.lexsort`.
+      2. The gaps between consecutive charges are found with `np.diff`,
+         discarding gaps that straddle two different merchants.
+      3. The median gap of each merchant is found by sorting the gaps by
+         (group, gap) and indexing into the middle of each group (see
+         `group_median`).
+      4. `np.bincount` counts how many gaps per merchant fall within
+         `TOLERANCE` of the median, and the median is matched against
+         the nearest entry in `CADENCES`.
+      5. Similarly, `np.bincount` counts how many charges per merchant
+         are within `AMOUNT_TOLERANCE` of the merchant's median amount.
+    """
+    if len(merchants) == 0:
+        return []
+
+    names, group = np.unique(merchants, return_inverse=True)
+    n_groups = len(names)
+
+    # Sort by merchant, then by time within each merchant
+    order = np.lexsort((created, group))
+    group = group[order]
+    amounts = amounts[order]
+    created = created[order].astype("datetime64[s]")
+    days = created.astype(np.int64) / 86400
+
+    # Gaps (in days) between consecutive charges from the same merchant
+    same = group[1:] == group[:-1]
+    gaps = np.diff(days)[same]
+    gap_group = group[1:][same]
+
+    # Median gap per merchant
+    n_gaps = np.bincount(gap_group, minlength=n_groups)
+    has_gaps = n_gaps > 0
+    median = group_median(gaps, gap_group, n_groups)
+
+    # Fraction of gaps that are within tolerance of the median
+    regular = np.abs(gaps - median[gap_group]) <= TOLERANCE * median[gap_group]
+    n_regular = np.bincount(gap_group, weights=regular, minlength=n_groups)
+    fraction = np.divide(
+        n_regular, n_gaps, out=np.zeros(n_groups), where=has_gaps
+    )
+
+    # Match the median gap against the nearest known cadence
+    periods = np.array([p for _, p in CADENCES])
+    error = np.abs(median[:, None] - periods[None, :]) / periods[None, :]
+    nearest = np.argmin(error, axis=1)
+    matched = error[np.arange(n_groups), nearest] <= TOLERANCE
+
+    # Fraction of charges that are within tolerance of the median amount
+    occurrences = n_gaps + 1
+    size = np.abs(amounts)
+    median_size = group_median(size, group, n_groups)
+    consistent = (
+        np.abs(size - median_size[group]) <= AMOUNT_TOLERANCE * median_size[group]
+    )
+    consistent_fraction = (
+        np.bincount(group, weights=consistent, minlength=n_groups) / occurrences
+    )
+
+    is_recurring = (
+        (occurrences >= MIN_OCCURRENCES)
+        & (fraction >= MIN_REGULAR_FRACTION)
+        & (consistent_fraction >= MIN_CONSISTENT_FRACTION)
+        & matched
+    )
+
+    # Typical charge is the most recent one (prices change over time)
+    last_idx = np.cumsum(np.bincount(group, minlength=n_groups)) - 1
+    last_amount = amounts[last_idx]
+    last_charged = created[last_idx]
+    next_expected = last_charged + (median * 86400).astype("timedelta64[s]")
+    last_charged = np.datetime_as_string(last_charged, unit="D")
+    next_expected = np.datetime_as_string(next_expected, unit="D")
+
+    return [
+        {
+            "merchant": str(names[i]),
+            "cadence": CADENCES[nearest[i]][0],
+            "interval_days": round(float(median[i]), 1),
+            "amount": int(last_amount[i]),
+            "occurrences": int(occurrences[i]),
+            "last_charged": str(last_charged[i]),
+            "next_expected": str(next_expected[i]),
+        }
+        for i in np.flatnonzero(is_recurring)
+    ]
+
+
+def update_recurring_payments() -> None:
+    """Updates the cached recurring payments in `data/transactions.db`.
+
+    Only merchants with transactions newer than the last analysed
+    transaction (stored in `recurring_payments_meta`) are re-analysed,
+    using their full history. If nothing has been analysed yet, the whole
+    cache is rebuilt. This is called at the end of `fetch_transactions`.
+    As the cache keeps its own record of what it has analysed,
+    transactions saved by a fetch that failed partway are picked up by
+    the next update.
+    """
+    conn = sqlite3.connect("data/transactions.db")
+    create_recurring_payments_table(conn)
+    cursor = conn.cursor()
+
+    cursor.execute("SELECT last_analysed FROM recurring_payments_meta")
+    row = cursor.fetchone()
+    since = row[0] if row else None
+
+    # Read this before analysing so that transactions inserted while we are
+    # working are picked up next time
+    cursor.execute("SELECT MAX(created) FROM transactions")
+    last_analysed = cursor.fetchone()[0]
+
+    # Only outgoing payments can be subscriptions
+    query = f"""
+    SELECT {MERCHANT_KEY}, amount, created
+    FROM transactions
+    WHERE amount < 0 AND {MERCHANT_KEY} IS NOT NULL
+    """
+    params = ()
+    if since:
+        query += f"""
+        AND {MERCHANT_KEY} IN (
+            SELECT DISTINCT {MERCHANT_KEY} FROM transactions
+            WHERE created > ?
+        )
+        """
+        params = (since,)
+    rows = cursor.execute(query, params).fetchall()
+
+    if rows:
+        merchants, amounts, created = zip(*rows)
+        # Timestamps are stored as e.g. "2024-09-19T20:30:00.000Z". NumPy
+        # does not accept the trailing "Z", so strip it before parsing.
+        created = np.char.rstrip(np.array(created), "Z")
+        recurring = detect_recurring_payments(
+            np.array(merchants),
+            np.array(amounts, dtype=np.int64),
+            created.astype("datetime64[ms]")
+        )
+        touched = [(m,) for m in set(merchants)]
+    else:
+        recurring, touched = [], []
+
+    # Replace the cached rows for every merchant we re-analysed. Merchants
+    # that no longer look recurring are simply removed.
+    if since:
+        cursor.executemany(
+            "DELETE FROM recurring_payments WHERE merchant = ?", touched
+        )
+    else:
+        cursor.execute("DELETE FROM recurring_payments")
+    cursor.executemany(
+        """
+        INSERT OR REPLACE INTO recurring_payments
+        (merchant, cadence, interval_days, amount, occurrences,
+        last_charged, next_expected)
+        VALUES (:merchant, :cadence, :interval_days, :amount, :occurrences,
+        :last_charged, :next_expected)
+        """,
+        recurring
+    )
+    cursor.execute(
+        "INSERT OR REPLACE INTO recurring_payments_meta VALUES (1, ?)",
+        (last_analysed,)
+    )
+
+    conn.commit()
+    conn.close()
+
+
+def get_recurring_payments() -> list[tuple]:
+    """Returns the cached recurring payments from `data/transactions.db`,
+    most expensive first.
+
+    Payments that are overdue by more than `TOLERANCE` of their interval
+    (e.g. a subscription that has since been cancelled) are left out.
+    This is checked against today's date when reading the cache, as the
+    cache is only updated when new transactions are fetched.
+    """
+    conn = sqlite3.connect("data/transactions.db")
+    create_recurring_payments_table(conn)
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+        SELECT merchant, cadence, amount, last_charged, next_expected
+        FROM recurring_payments
+        WHERE julianday(next_expected) + ? * interval_days
+            >= julianday('now', 'start of day')
+        ORDER BY amount ASC
+        """,
+        (TOLERANCE,)
+    )
+    results = cursor.fetchall()
+    conn.close()
+    return results